@@ -1,9 +1,15 @@
+import argparse
+import asyncio
+import hashlib
 import logging
-from decimal import Decimal
+import os
+import random
+import time
+from decimal import Decimal, InvalidOperation
 from typing import Union, Dict
-from datetime import datetime
+from datetime import datetime, timezone
 
-import requests
+import httpx
 from telegram import (
     ReplyKeyboardMarkup, 
     InlineKeyboardButton, 
@@ -19,6 +25,7 @@ from telegram.ext import (
     CallbackQueryHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 
 # Enable logging
 logging.basicConfig(
@@ -28,8 +35,27 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
+def _require_env(name: str) -> str:
+    """Read a required environment variable, failing fast if it is missing."""
+    value = os.environ.get(name, "").strip()
+    if not value:
+        raise RuntimeError(f"The {name} environment variable must be set")
+    return value
+
+TELEGRAM_TOKEN = _require_env("TELEGRAM_TOKEN")
+AIRTABLE_TOKEN = _require_env("AIRTABLE_TOKEN")
+
 CHOOSING, TYPING_REPLY, TYPING_CHOICE, TYPING_APT = range(4)
 
+# Shared async HTTP client so outgoing calls never block the event loop.
+# Keep-alive connections are reused across calls, so repeated requests to
+# the same host skip the TCP/TLS handshake after the first one.
+HTTP = httpx.AsyncClient(
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+    transport=httpx.AsyncHTTPTransport(retries=3),
+)
+
 reply_keyboard = [
     ["Name of Expense", "Expense Type"],
     ["Amount in GHS", "Notes", "Apt"],
@@ -47,10 +73,35 @@ apt_options = [
     ("Option 108", "108")
 ]
 
+# These keyboards never change, so build them once instead of on every update.
+# Two expense types per row halves the row count and the message payload.
+_expense_rows = [expense_types[i:i + 2] for i in range(0, len(expense_types), 2)]
+EXPENSE_TYPE_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(expense, callback_data=expense) for expense in row] for row in _expense_rows]
+)
+APT_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(name, callback_data=value)] for name, value in apt_options]
+)
+
+# The event loop keeps only weak references to tasks, so background sends
+# must be held here until they finish or they can be garbage-collected
+# mid-flight; failures are logged instead of dying as unretrieved exceptions.
+_bg_tasks = set()
+
+def _reply_done(task: asyncio.Task) -> None:
+    _bg_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background reply failed", exc_info=task.exception())
+
+def _send_in_background(coro) -> None:
+    """Send a reply as a background task without dropping the reference."""
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_reply_done)
+
 def facts_to_str(user_data: Dict[str, str]) -> str:
     """Helper function for formatting the gathered user info."""
-    facts = [f"{key} - {value}" for key, value in user_data.items()]
-    return "\n".join(facts).join(["\n", "\n"])
+    return "\n" + "\n".join(f"{key} - {value}" for key, value in user_data.items()) + "\n"
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the conversation and ask user for input."""
@@ -77,12 +128,9 @@ async def regular_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def expense_type_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Display a list of predefined expense types for the user to choose from."""
-    keyboard = [[InlineKeyboardButton(expense, callback_data=expense)] for expense in expense_types]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         "Please choose an expense type from the list below:",
-        reply_markup=reply_markup
+        reply_markup=EXPENSE_TYPE_MARKUP
     )
 
     return TYPING_CHOICE
@@ -103,21 +151,22 @@ async def expense_type_selected(update: Update, context: ContextTypes.DEFAULT_TY
         "You can tell me more, or change your opinion on something."
     )
     
-    await query.message.reply_text(
-        summary_text.format(selected_expense_type=selected_expense_type),
-        reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True)
+    # Send the summary in the background; the callback is already answered,
+    # so there is no need to hold the handler open for the reply round trip.
+    _send_in_background(
+        query.message.reply_text(
+            summary_text.format(selected_expense_type=selected_expense_type),
+            reply_markup=markup
+        )
     )
 
     return CHOOSING
 
 async def apt_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Display a list of Apt options for the user to choose from."""
-    keyboard = [[InlineKeyboardButton(name, callback_data=value)] for name, value in apt_options]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         "Please choose an Apt option from the list below:",
-        reply_markup=reply_markup
+        reply_markup=APT_MARKUP
     )
 
     return TYPING_APT
@@ -138,9 +187,11 @@ async def apt_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         "You can tell me more, or change your opinion on something."
     )
     
-    await query.message.reply_text(
-        summary_text.format(selected_apt=selected_apt),
-        reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True)
+    _send_in_background(
+        query.message.reply_text(
+            summary_text.format(selected_apt=selected_apt),
+            reply_markup=markup
+        )
     )
 
     return CHOOSING
@@ -159,12 +210,12 @@ async def received_information(update: Update, context: ContextTypes.DEFAULT_TYP
             "Neat! Just so you know, this is what you already told me:"
             f"{facts_to_str(user_data)}You can tell me more, or change your opinion"
             " on something.",
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True),
+            reply_markup=markup,
         )
     else:
         await update.message.reply_text(
             "I didn't receive the category. Please try again.",
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True),
+            reply_markup=markup,
         )
         
     return CHOOSING
@@ -184,7 +235,7 @@ async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     try:
         amount_ghs = Decimal(amount_str)
-    except:
+    except (InvalidOperation, TypeError):
         amount_ghs = Decimal(0)
 
     # Convert amount to USD
@@ -192,7 +243,9 @@ async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     amount_usd = amount_ghs * Decimal(exchange_rate)
 
     # Call update_airtable function
-    response = await update_airtable(name, expense_type, amount_usd, notes, apt)
+    response = await update_airtable(
+        name, expense_type, amount_usd, notes, apt, update.effective_user.id
+    )
     
     # Print the data for debugging
     logger.info(f"Data sent to Airtable: Name: {name}, Expense Type: {expense_type}, Amount (USD): {amount_usd}, Notes: {notes}, Apt: {apt}")
@@ -207,62 +260,240 @@ async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_data.clear()
     return ConversationHandler.END
 
+class AsyncTokenBucket:
+    """Token bucket that paces coroutines to ``rate`` acquisitions per second."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available, then consume it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+# Airtable endpoints keyed by Apt value; adding a base is a one-line change.
+AIRTABLE_URLS = {
+    "108": "https://api.airtable.com/v0/appT4yGhNwVtyB8jR/Income%20%26%20Expenses",
+    "103": "https://api.airtable.com/v0/appqfgm6p6MSGLfI3/Income%20%26%20Expenses",
+}
+
+AIRTABLE_HEADERS = {
+    "Authorization": f"Bearer {AIRTABLE_TOKEN}",
+    "Content-Type": "application/json"
+}
+
+# One bucket per Airtable base, paced just under the 5 req/s limit.
+BUCKETS = {
+    "108": AsyncTokenBucket(4.5, 5),
+    "103": AsyncTokenBucket(4.5, 5),
+}
+
+# Airtable accepts up to 10 records per POST, so pending writes are queued
+# per base and flushed together instead of one request per record.
+MAX_BATCH = 10
+FLUSH_MS = 250
+BATCH_QUEUES: Dict[str, asyncio.Queue] = {
+    "108": asyncio.Queue(),
+    "103": asyncio.Queue(),
+}
+
+# FX rates only move on an hours-scale, so cache the fetched rate instead
+# of hitting the API on every submission.
+_FX_CACHE = {"rate": None, "ts": 0.0}
+_FX_TTL = 3600  # seconds
+
 async def get_exchange_rate() -> float:
-    """Fetch the current exchange rate from GHS to USD."""
+    """Fetch the current exchange rate from GHS to USD, cached for an hour."""
+    if _FX_CACHE["rate"] is not None and time.time() - _FX_CACHE["ts"] < _FX_TTL:
+        return _FX_CACHE["rate"]
+
     url = "https://api.exchangerate-api.com/v4/latest/GHS"
-    response = requests.get(url)
-    data = response.json()
-    return data["rates"].get("USD", 1.0)  # Default to 1.0 if USD rate not found
-
-async def update_airtable(name: str, expense_type: str, expense: Union[Decimal, float], notes: str, apt: str) -> dict:
-    # Determine the URL based on the value of `apt`
-    if apt == "108":
-        url = "https://api.airtable.com/v0/appT4yGhNwVtyB8jR/Income%20%26%20Expenses"
-    elif apt == "103":
-        url = "https://api.airtable.com/v0/appqfgm6p6MSGLfI3/Income%20%26%20Expenses"
-    else:
+    try:
+        response = await HTTP.get(url)
+        response.raise_for_status()
+        data = response.json()
+    except httpx.HTTPError:
+        if _FX_CACHE["rate"] is not None:
+            logger.warning("Exchange rate fetch failed, using stale FX rate")
+            return _FX_CACHE["rate"]
+        raise
+
+    rate = data["rates"].get("USD", 1.0)  # Default to 1.0 if USD rate not found
+    _FX_CACHE["rate"] = rate
+    _FX_CACHE["ts"] = time.time()
+    return rate
+
+async def update_airtable(name: str, expense_type: str, expense: Union[Decimal, float], notes: str, apt: str, user_id: int = 0) -> dict:
+    if apt not in BATCH_QUEUES:
         raise ValueError("Invalid apt value")
 
-    headers = {
-        "Authorization": "Bearer Bearer",  # Replace with your actual API key
-        "Content-Type": "application/json"
+    now = datetime.now(timezone.utc)  # One timestamp so month and date can't straddle midnight
+    current_month = now.strftime("%B")  # Get the current month as a full month name
+    current_date = now.date().isoformat()  # YYYY-MM-DD without the strftime format parser
+
+    fields = {
+        "Name": name,
+        "Month": current_month,
+        "Category": expense_type,
+        "Expense": float(expense),
+        "Notes": notes,
+        "Date": current_date
     }
-    
-    current_month = datetime.now().strftime("%B")  # Get the current month as a full month name
-    current_year = datetime.now().year  # Get the current year
-    current_date = datetime.now().strftime("%Y-%m-%d")  # Get the current date in YYYY-MM-DD format
-
-    data = {
-        "records": [
-            {
-                "fields": {
-                    "Name": name,
-                    "Month": current_month,
-                    "Category": expense_type,
-                    "Expense": float(expense),
-                    "Notes": notes,
-                    # "Year": current_year,
-                    "Date": current_date
-                }
-            }
-        ],
-        "typecast": True
+
+    # The timestamp makes the key unique per submission, so two legitimate
+    # identical expenses stay distinct; retries of one submission reuse it.
+    fields["IdemKey"] = hashlib.blake2b(
+        f"{user_id}|{name}|{fields['Expense']}|{now.isoformat()}".encode(),
+        digest_size=16,
+    ).hexdigest()
+
+    # Hand the record to the per-base flusher and wait for its slice of
+    # the batched response.
+    future = asyncio.get_running_loop().create_future()
+    await BATCH_QUEUES[apt].put((fields, future))
+    return await future
+
+async def _find_written(url: str, idem_keys: list) -> dict:
+    """Look up records that already landed server-side, keyed by IdemKey."""
+    formula = "OR(" + ",".join(f'{{IdemKey}}="{key}"' for key in idem_keys) + ")"
+    response = await HTTP.get(url, headers=AIRTABLE_HEADERS, params={"filterByFormula": formula})
+    response.raise_for_status()
+    return {
+        record["fields"].get("IdemKey"): record
+        for record in response.json().get("records", [])
     }
 
-    # Print the URL and data for debugging purposes
-    print(f"URL being used: {url}")
-    print("Data being sent to Airtable:", data)
+async def _post_batch(apt: str, records: list) -> dict:
+    """POST a batch of records to the Airtable base for `apt`."""
+    url = AIRTABLE_URLS.get(apt)
+    if url is None:
+        raise ValueError("Invalid apt value")
 
-    response = requests.post(url, headers=headers, json=data, timeout=10)
-    response.raise_for_status()
-    response_json = response.json()
-    
-    return response_json
+    logger.debug("Airtable POST %s payload=%s", url, records)
+
+    # Airtable allows 5 req/s per base and answers 429 with a cool-down;
+    # retry transient 429/5xx responses with exponential backoff and jitter
+    # instead of surfacing them straight to the user.
+    written = {}  # IdemKey -> record confirmed on the server
+    pending = records
+    for attempt in range(5):
+        await BUCKETS[apt].acquire()
+        response = await HTTP.post(url, headers=AIRTABLE_HEADERS, json={"records": pending, "typecast": True})
+        if response.status_code == 429:
+            # Rejected before anything was written; retry the batch as-is.
+            delay = int(response.headers.get("Retry-After", 2 ** attempt))
+            await asyncio.sleep(delay + random.uniform(0, 0.5))
+            continue
+        if 500 <= response.status_code < 600:
+            # Ambiguous failure: the write may have landed before the error.
+            # Drop records whose IdemKey is already on the server so the
+            # retry can't create duplicate rows.
+            await asyncio.sleep(2 ** attempt + random.uniform(0, 0.5))
+            try:
+                written.update(
+                    await _find_written(url, [r["fields"]["IdemKey"] for r in pending])
+                )
+            except httpx.HTTPError:
+                logger.warning("IdemKey lookup failed, retrying the full batch")
+            pending = [r for r in pending if r["fields"]["IdemKey"] not in written]
+            if pending:
+                continue
+            break
+        response.raise_for_status()
+        # Airtable returns created records in request order.
+        for record, created in zip(pending, response.json().get("records", [])):
+            written[record["fields"]["IdemKey"]] = created
+        break
+    else:
+        response.raise_for_status()
+
+    return {"records": [written.get(r["fields"]["IdemKey"]) for r in records]}
+
+async def _flusher(apt: str) -> None:
+    """Collect queued records for `apt` and flush them in batches."""
+    queue = BATCH_QUEUES[apt]
+    while True:
+        batch = [await queue.get()]
+        deadline = time.monotonic() + FLUSH_MS / 1000
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        records = [{"fields": fields} for fields, _ in batch]
+        try:
+            response = await _post_batch(apt, records)
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            continue
+
+        # Airtable returns created records in request order; hand each
+        # caller its own one-record slice of the response; an unconfirmed
+        # record yields an empty slice, which done() reports as a failure.
+        for (_, future), record in zip(batch, response.get("records", [])):
+            if not future.done():
+                future.set_result({"records": [record] if record else []})
+
+_flush_tasks = []
+
+async def _start_flushers(application: Application) -> None:
+    """Start one batch-flusher task per Airtable base."""
+    for apt in BATCH_QUEUES:
+        _flush_tasks.append(asyncio.create_task(_flusher(apt)))
+
+async def _close_http(application: Application) -> None:
+    """Stop the batch flushers and close the shared HTTP client on shutdown."""
+    for task in _flush_tasks:
+        task.cancel()
+    await HTTP.aclose()
 
 def main() -> None:
     """Run the bot."""
+    parser = argparse.ArgumentParser(description="Telegram expense bot")
+    parser.add_argument(
+        "--polling",
+        action="store_true",
+        help="Use getUpdates long-polling instead of a webhook (for development)",
+    )
+    args = parser.parse_args()
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token("Your_token").build()
+    # A larger pool for outgoing API calls and a small dedicated one for
+    # getUpdates, so bursts of replies don't exhaust the default pool.
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .request(
+            HTTPXRequest(
+                connection_pool_size=32,
+                pool_timeout=10.0,
+                connect_timeout=5.0,
+                read_timeout=20.0,
+            )
+        )
+        .get_updates_request(HTTPXRequest(connection_pool_size=4, read_timeout=40.0))
+        .concurrent_updates(True)
+        .post_init(_start_flushers)
+        .post_shutdown(_close_http)
+        .build()
+    )
 
     # Add conversation handler with the states CHOOSING, TYPING_CHOICE, TYPING_REPLY, and TYPING_APT
     conv_handler = ConversationHandler(
@@ -270,7 +501,8 @@ def main() -> None:
         states={
             CHOOSING: [
                 MessageHandler(
-                    filters.Regex("^(Name of Expense|Expense Type|Amount in GHS|Notes|Apt)$"), regular_choice
+                    filters.Text({"Name of Expense", "Expense Type", "Amount in GHS", "Notes", "Apt"}),
+                    regular_choice,
                 ),
             ],
             TYPING_CHOICE: [
@@ -281,18 +513,31 @@ def main() -> None:
             ],
             TYPING_REPLY: [
                 MessageHandler(
-                    filters.TEXT & ~(filters.COMMAND | filters.Regex("^Done$")),
+                    filters.TEXT & ~(filters.COMMAND | filters.Text({"Done"})),
                     received_information,
                 ),
             ],
         },
-        fallbacks=[MessageHandler(filters.Regex("^Done$"), done)],
+        fallbacks=[MessageHandler(filters.Text({"Done"}), done)],
     )
 
     application.add_handler(conv_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Run the bot until the user presses Ctrl-C. Production uses a webhook
+    # behind a TLS-terminating proxy (nginx/Caddy) pointing WEBHOOK_URL at
+    # this process; long-polling stays available for development.
+    if args.polling:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        port = int(os.environ.get("PORT", "8443"))
+        webhook_url = _require_env("WEBHOOK_URL").rstrip("/")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"{webhook_url}/{TELEGRAM_TOKEN}",
+            allowed_updates=Update.ALL_TYPES,
+        )
 
 if __name__ == "__main__":
     main()